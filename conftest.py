@@ -463,7 +463,7 @@ def make_repo(capsys, request, config, tunnel, users):
                 'content_type': 'json',
                 'insecure_ssl': '1',
             },
-            'events': ['pull_request', 'issue_comment', 'status', 'pull_request_review']
+            'events': ['pull_request', 'issue_comment', 'status', 'pull_request_review', 'push']
         }))
         time.sleep(1)
 
@@ -287,15 +287,18 @@ class GC(models.TransientModel):
     _description = "Weekly maintenance of... cache repos?"
 
     def _run(self):
-        # lock out the forward port cron to avoid concurrency issues while we're
-        # GC-ing it: wait until it's available, then SELECT FOR UPDATE it,
-        # which should prevent cron workers from running it
-        fp_cron = self.env.ref('forwardport.port_forward')
+        # lock out the forward port crons to avoid concurrency issues while
+        # we're GC-ing it: wait until they're available, then SELECT FOR UPDATE
+        # them, which should prevent cron workers from running them. Both
+        # create working copies sharing the objects of the cache repo, so
+        # pruning while they run could remove objects they rely on
+        fp_crons = self.env.ref('forwardport.port_forward') \
+                 | self.env.ref('forwardport.updates')
         self.env.cr.execute("""
             SELECT 1 FROM ir_cron
-            WHERE id = %s
+            WHERE id = any(%s)
             FOR UPDATE
-        """, [fp_cron.id])
+        """, [fp_crons.ids])
 
         repos_dir = pathlib.Path(user_cache_dir('forwardport'))
         # run on all repos with a forwardport target (~ forwardport enabled)
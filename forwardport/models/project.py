@@ -16,6 +16,7 @@ import base64
 import collections
 import contextlib
 import datetime
+import functools
 import itertools
 import json
 import logging
@@ -44,6 +45,16 @@ footer = '\nMore info at https://github.com/odoo/odoo/wiki/Mergebot#forward-port
 
 DEFAULT_DELTA = dateutil.relativedelta.relativedelta(days=3)
 
+@functools.lru_cache(maxsize=1)
+def _repos_dir():
+    """ Cache directory for the local repositories and working copies,
+    created on first use (resolving it involves a bit of environment and
+    platform probing so it's only done once).
+    """
+    repos_dir = pathlib.Path(user_cache_dir('forwardport'))
+    repos_dir.mkdir(parents=True, exist_ok=True)
+    return repos_dir
+
 _logger = logging.getLogger('odoo.addons.forwardport')
 
 class Project(models.Model):
@@ -887,23 +898,36 @@ This PR targets %s and is part of the forward-port chain. Further PRs will be cr
                         root.display_name,
                         target_branch.name
                     ),
-                    dir=user_cache_dir('forwardport')
+                    dir=_repos_dir()
                 )),
-            branch=target_branch.name
+            branch=target_branch.name,
+            # the working copy is short-lived, so just borrow the cache
+            # repo's objects rather than copy its entire object store
+            shared=True,
         )
 
-        r = working_copy.with_config(stdout=subprocess.PIPE, stderr=subprocess.STDOUT) \
-            .fetch(self._source_url, root.head)
-        logger.info(
-            "Fetched head of %s into %s:\n%s",
-            root.display_name,
-            working_copy._directory,
-            r.stdout.decode()
-        )
+        # the head may already be in the cache repo (e.g. pushed there while
+        # updating a forward-port chain) and thus visible through the shared
+        # clone, only go to github if it's missing
         if working_copy.check(False).cat_file(e=root.head).returncode:
-            raise ForwardPortError(
-                f"During forward port of {self.display_name}, unable to find "
-                f"expected head of {root.display_name} ({root.head})"
+            r = working_copy.with_config(stdout=subprocess.PIPE, stderr=subprocess.STDOUT) \
+                .fetch(self._source_url, root.head)
+            logger.info(
+                "Fetched head of %s into %s:\n%s",
+                root.display_name,
+                working_copy._directory,
+                r.stdout.decode()
+            )
+            if working_copy.check(False).cat_file(e=root.head).returncode:
+                raise ForwardPortError(
+                    f"During forward port of {self.display_name}, unable to find "
+                    f"expected head of {root.display_name} ({root.head})"
+                )
+        else:
+            logger.info(
+                "Head of %s already available in %s",
+                root.display_name,
+                working_copy._directory,
             )
 
         project_id = self.repository.project_id
@@ -1089,9 +1113,7 @@ stderr:
         return msg
 
     def _get_local_directory(self):
-        repos_dir = pathlib.Path(user_cache_dir('forwardport'))
-        repos_dir.mkdir(parents=True, exist_ok=True)
-        repo_dir = repos_dir / self.repository.name
+        repo_dir = _repos_dir() / self.repository.name
 
         if repo_dir.is_dir():
             return git(repo_dir)
@@ -1267,9 +1289,17 @@ class Repo:
         r._params = args
         return r
 
-    def clone(self, to, branch=None):
+    def clone(self, to, branch=None, shared=False):
+        """ Clones the repository to ``to``
+
+        :param shared: borrow the objects of the source repository (via
+                       alternates) instead of copying / hardlinking them, the
+                       source must outlive the clone and not be pruned of
+                       objects the clone relies on
+        """
         self._run(
             'clone',
+            *(['--shared'] if shared else []),
             *([] if branch is None else ['-b', branch]),
             self._directory, to,
         )
@@ -310,6 +310,18 @@ def handle_review(env, event):
         env, repo, pr, event['review'],
         target=event['pull_request']['base']['ref'])
 
+def handle_push(env, event):
+    ref = event['ref']
+    if not ref.startswith('refs/heads/staging.'):
+        return "Ignoring push to %s" % ref
+
+    repo = event['repository']['full_name']
+    head = event['after']
+    _logger.info("push: %s:%s -> %s", repo, ref, head)
+    if utils.staging_visibility.signal(repo, head):
+        return "Signalled %s" % head
+    return "Nothing waiting on %s" % head
+
 def handle_ping(env, event):
     print("Got ping! {}".format(event['zen']))
     return "pong"
@@ -319,6 +331,7 @@ EVENTS = {
     'status': handle_status,
     'issue_comment': handle_comment,
     'pull_request_review': handle_review,
+    'push': handle_push,
     'ping': handle_ping,
 }
 
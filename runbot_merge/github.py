@@ -1,4 +1,6 @@
+import collections
 import collections.abc
+import concurrent.futures
 import itertools
 import json as json_
 import logging
@@ -7,10 +9,13 @@ import os
 import pathlib
 import pprint
 import textwrap
+import threading
 import unicodedata
 
 import requests
+import requests.adapters
 import werkzeug.urls
+from urllib3.util.retry import Retry
 
 import odoo.netsvc
 from odoo.tools import topological_sort, config
@@ -47,6 +52,37 @@ def _init_gh_logger():
 if odoo.netsvc._logger_init:
     _init_gh_logger()
 
+# requests sessions are not guaranteed to be thread-safe, so clients are
+# cached per thread. Only cron threads are long-lived enough for connections
+# to get reused: the threaded server spawns a new thread per http request, so
+# webhooks and controllers get a fresh cache (discarded with the thread)
+_cache = threading.local()
+CACHE_SIZE = 32
+def cached(token, repo):
+    """ Returns a :class:`GH` for ``repo``, shared with previous calls *from
+    the current thread* for the same repository and token so the underlying
+    connections can be kept alive between requests (and cron runs).
+
+    The cache is a bounded LRU, so clients for stale tokens (or repositories)
+    eventually get evicted.
+
+    .. warning:: the client must not be used concurrently from other threads
+    """
+    clients = getattr(_cache, 'clients', None)
+    if clients is None:
+        clients = _cache.clients = collections.OrderedDict()
+
+    key = (token, repo)
+    gh = clients.get(key)
+    if gh is None:
+        gh = clients[key] = GH(token, repo)
+        while len(clients) > CACHE_SIZE:
+            _, evicted = clients.popitem(last=False)
+            evicted._session.close()
+    else:
+        clients.move_to_end(key)
+    return gh
+
 GH_LOG_PATTERN = """=> {method} /{self._repo}/{path}{qs}{body}
 
 <= {r.status_code} {r.reason}
@@ -61,6 +97,20 @@ class GH(object):
         session = self._session = requests.Session()
         session.headers['Authorization'] = 'token {}'.format(token)
         session.headers['Accept'] = 'application/vnd.github.symmetra-preview+json'
+        # only retries idempotent requests, and returns the last response
+        # rather than raising so callers can handle the status as usual
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[502, 503, 504],
+                raise_on_status=False,
+            ),
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
 
     def _log_gh(self, logger, method, path, params, json, response, level=logging.INFO):
         """ Logs a pair of request / response to github, to the specified
@@ -372,16 +422,59 @@ class GH(object):
         """ Returns a PR's commits oldest first (that's what GH does &
         is what we want)
         """
-        commits = list(self.commits_lazy(pr))
-        # map shas to the position the commit *should* have
-        idx =  {
-            c: i
-            for i, c in enumerate(topological_sort({
-                c['sha']: [p['sha'] for p in c['parents']]
-                for c in commits
-            }))
+        return _sort_commits(list(self.commits_lazy(pr)))
+
+    def pr_with_commits(self, number):
+        """ Fetches a PR and its commits (oldest first) in a single graphql
+        query rather than the 3+ REST calls of :meth:`pr` and
+        :meth:`commits`. The results are shaped like the REST objects but
+        only provide the fields necessary for staging.
+
+        Falls back to the REST API if the query fails or the PR has too many
+        commits to fetch in one go.
+        """
+        owner, name = self._repo.split('/')
+        try:
+            data = self.graphql(PR_WITH_COMMITS, {'owner': owner, 'name': name, 'number': number})
+        except (requests.HTTPError, ValueError):
+            data = {}
+
+        pr = None
+        if not data.get('errors'):
+            pr = ((data.get('data') or {}).get('repository') or {}).get('pullRequest')
+        if not pr or pr['commits']['totalCount'] > len(pr['commits']['nodes']):
+            _logger.info("pr_with_commits(%s, %s) -> falling back to REST", self._repo, number)
+            _, prdict = self.pr(number)
+            return prdict, self.commits(number)
+
+        prdict = {
+            'title': pr['title'],
+            'body': pr['body'],
+            'base': {'ref': pr['baseRefName']},
+            'commits': pr['commits']['totalCount'],
         }
-        return sorted(commits, key=lambda c: idx[c['sha']])
+        return prdict, _sort_commits([
+            {
+                'sha': c['oid'],
+                'parents': [{'sha': p['oid']} for p in c['parents']['nodes']],
+                'commit': {
+                    'message': c['message'],
+                    'author': c['author'],
+                    'committer': c['committer'],
+                },
+            }
+            for c in (n['commit'] for n in pr['commits']['nodes'])
+        ])
+
+    def graphql(self, query, variables=None):
+        """ Performs a graphql request, returns the decoded response body
+        (both ``data`` and ``errors``, as a request can partially succeed)
+        """
+        payload = {'query': query, 'variables': variables or {}}
+        r = self._session.post(self._url + '/graphql', json=payload)
+        self._log_gh(_gh, 'POST', 'graphql', None, payload, r)
+        r.raise_for_status()
+        return r.json()
 
     def statuses(self, h):
         r = self('get', 'commits/{}/status'.format(h)).json()
@@ -390,6 +483,118 @@ class GH(object):
             **s,
         } for s in r['statuses']]
 
+def copy_refs(ghs, source, dest):
+    """ Force-updates (or creates) branch ``dest`` to the current head of
+    branch ``source`` on every repository of ``ghs``, which must all use the
+    same token.
+
+    The heads are looked up and the branches updated with one graphql
+    request each for all the repositories, rather than a few REST calls per
+    repository. Repositories for which graphql fails fall back to the REST
+    API.
+
+    :param list[GH] ghs:
+    :returns: the ``source`` head of each repository
+    :rtype: list[str]
+    """
+    if not ghs:
+        return []
+    gh = ghs[0]
+    lit = json_.dumps # json strings are valid graphql string literals
+
+    try:
+        data = gh.graphql('query { %s }' % ' '.join(
+            f'r{i}: repository(owner: {lit(owner)}, name: {lit(name)}) {{'
+            f' id'
+            f' source: ref(qualifiedName: {lit("refs/heads/" + source)}) {{ target {{ oid }} }}'
+            f' dest: ref(qualifiedName: {lit("refs/heads/" + dest)}) {{ id }}'
+            f' }}'
+            for i, (owner, name) in enumerate(g._repo.split('/') for g in ghs)
+        )).get('data') or {}
+    except (requests.HTTPError, ValueError):
+        data = {}
+
+    heads = []
+    mutations = []
+    for i, g in enumerate(ghs):
+        repo = data.get(f'r{i}') or {}
+        head = ((repo.get('source') or {}).get('target') or {}).get('oid')
+        if head is None:
+            head = g.head(source)
+        heads.append(head)
+
+        if repo.get('dest'):
+            mutations.append(
+                f'r{i}: updateRef(input: {{refId: {lit(repo["dest"]["id"])}, oid: {lit(head)}, force: true}})'
+                f' {{ ref {{ target {{ oid }} }} }}'
+            )
+        elif repo.get('id'):
+            mutations.append(
+                f'r{i}: createRef(input: {{repositoryId: {lit(repo["id"])}, name: {lit("refs/heads/" + dest)}, oid: {lit(head)}}})'
+                f' {{ ref {{ target {{ oid }} }} }}'
+            )
+
+    updated = {}
+    if mutations:
+        try:
+            updated = gh.graphql('mutation { %s }' % ' '.join(mutations)).get('data') or {}
+        except (requests.HTTPError, ValueError):
+            pass
+
+    def check(i):
+        g, head = ghs[i], heads[i]
+        ref = (updated.get(f'r{i}') or {}).get('ref') or {}
+        if (ref.get('target') or {}).get('oid') != head:
+            _logger.info("copy_refs(%s, %s, %s) -> falling back to REST", g._repo, source, dest)
+            g.set_ref(dest, head)
+            return
+        # same sanity check as set_ref, so the REST API sees the update
+        @utils.backoff(exc=AssertionError)
+        def _wait_for_update():
+            h = g._check_updated(dest, head)
+            assert not h, f"Sanity check ref update of {dest}, expected {head} got {h}"
+    # each GH is only used by a single worker
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ghs)) as pool:
+        list(pool.map(check, range(len(ghs))))
+    return heads
+
+def _sort_commits(commits):
+    # map shas to the position the commit *should* have
+    idx =  {
+        c: i
+        for i, c in enumerate(topological_sort({
+            c['sha']: [p['sha'] for p in c['parents']]
+            for c in commits
+        }))
+    }
+    return sorted(commits, key=lambda c: idx[c['sha']])
+
+# graphql connections are limited to 100 nodes per page, larger PRs fall back
+# to the REST API
+PR_WITH_COMMITS = """
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      title
+      body
+      baseRefName
+      commits(first: 100) {
+        totalCount
+        nodes {
+          commit {
+            oid
+            message
+            author { name email date }
+            committer { name email date }
+            parents(first: 100) { nodes { oid } }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
 def shorten(s):
     if not s:
         return s
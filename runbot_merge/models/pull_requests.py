@@ -1,34 +1,34 @@
 # coding: utf-8
 
 import ast
-import base64
 import collections
+import concurrent.futures
 import contextlib
 import datetime
-import io
+import difflib
+import functools
 import itertools
 import json
 import logging
 import os
 import pprint
 import re
+import secrets
+import subprocess
 import time
 
-from difflib import Differ
 from itertools import takewhile
 
-import requests
 import werkzeug
 from werkzeug.datastructures import Headers
 
 from odoo import api, fields, models, tools
 from odoo.exceptions import ValidationError
 from odoo.osv import expression
-from odoo.tools import OrderedSet
 
 from .. import github, exceptions, controllers, utils
 
-WAIT_FOR_VISIBILITY = [10, 10, 10, 10]
+WAIT_FOR_VISIBILITY = [0.5, 1, 2, 4, 8, 16]
 
 _logger = logging.getLogger(__name__)
 
@@ -97,7 +97,7 @@ All substitutions are tentatively applied sequentially to the input.
         return super().write(vals)
 
     def github(self, token_field='github_token'):
-        return github.GH(self.project_id[token_field], self.name)
+        return github.cached(self.project_id[token_field], self.name)
 
     def _auto_init(self):
         res = super(Repository, self)._auto_init()
@@ -284,7 +284,7 @@ class Branch(models.Model):
         for b in self:
             b.active_staging_id = b.with_context(active_test=True).staging_ids
 
-    def _ready(self):
+    def _stageable(self):
         self.env.cr.execute("""
         SELECT
           min(pr.priority) as priority,
@@ -302,20 +302,21 @@ class Branch(models.Model):
                     THEN pr.id::text
                 ELSE pr.label
             END
+        -- replicates PullRequests._compute_is_blocked, so only stageable
+        -- batches are returned: all PRs must have a merge method, and
+        -- either one of them is p=0 and none is in error, or all are ready
         HAVING
-            bool_or(pr.state = 'ready') or bool_or(pr.priority = 0)
+            bool_and(coalesce(pr.squash, false) OR pr.merge_method IS NOT NULL)
+            AND CASE
+                WHEN bool_or(pr.priority = 0)
+                    THEN NOT bool_or(pr.state = 'error')
+                ELSE bool_and(pr.state = 'ready')
+            END
         ORDER BY min(pr.priority), min(pr.id)
         """, [self.ids])
         browse = self.env['runbot_merge.pull_requests'].browse
         return [(p, browse(ids)) for p, ids in self.env.cr.fetchall()]
 
-    def _stageable(self):
-        return [
-            (p, prs)
-            for p, prs in self._ready()
-            if not any(prs.mapped('blocked'))
-        ]
-
     def try_staging(self):
         """ Tries to create a staging if the current branch does not already
         have one. Returns None if the branch already has a staging or there
@@ -351,15 +352,27 @@ class Branch(models.Model):
         if not batched_prs:
             return
 
+        # batches are browsed separately so don't share a prefetch set, load
+        # everything staging needs upfront instead of one query per PR
+        all_prs = self.env['runbot_merge.pull_requests'].concat(*batched_prs)
+        all_prs.read([
+            'display_name', 'number', 'message', 'head', 'squash',
+            'merge_method', 'target', 'repository', 'reviewed_by', 'priority',
+        ])
+        all_prs.mapped('reviewed_by').read(['name', 'email', 'github_login'])
+        all_prs.mapped('repository').read(['name'])
+
         Batch = self.env['runbot_merge.batch']
         staged = Batch
         original_heads = {}
-        meta = {repo: {} for repo in self.project_id.repo_ids.having_branch(self)}
-        for repo, it in meta.items():
-            gh = it['gh'] = repo.github()
-            it['head'] = original_heads[repo] = gh.head(self.name)
-            # create tmp staging branch
-            gh.set_ref('tmp.{}'.format(self.name), it['head'])
+        meta = {repo: {'gh': repo.github()} for repo in self.project_id.repo_ids.having_branch(self)}
+        # create tmp staging branches, for all repositories at once
+        heads = github.copy_refs(
+            [it['gh'] for it in meta.values()],
+            self.name, 'tmp.{}'.format(self.name),
+        )
+        for (repo, it), head in zip(meta.items(), heads):
+            it['head'] = original_heads[repo] = head
 
         batch_limit = self.project_id.batch_limit
         first = True
@@ -399,7 +412,7 @@ class Branch(models.Model):
             tree = it['gh'].commit(it['head'])['tree']
             # ensures staging branches are unique and always
             # rebuilt
-            r = base64.b64encode(os.urandom(12)).decode('ascii')
+            r = secrets.token_urlsafe(9)
             trailer = ''
             if heads:
                 trailer = '\n'.join(
@@ -425,12 +438,16 @@ For-Commit-Id: %s
             # might be the same)
             heads[repo.name + '^'] = it['head']
             heads[repo.name] = dummy_head['sha']
-            self.env.cr.execute(
-                "INSERT INTO runbot_merge_commit (sha, to_check, statuses) "
-                "VALUES (%s, true, '{}') "
-                "ON CONFLICT (sha) DO UPDATE SET to_check=true",
-                [dummy_head['sha']]
-            )
+
+        # create (or flag) all the commits to check in a single statement,
+        # deduplicated as ON CONFLICT can't update the same row twice
+        self.env.cr.execute("""
+        INSERT INTO runbot_merge_commit (sha, to_check, statuses)
+        SELECT sha, true, '{}' FROM unnest(%s) sha
+        ON CONFLICT (sha) DO UPDATE SET to_check=true
+        """, [list(dict.fromkeys(
+            sha for name, sha in heads.items() if not name.endswith('^')
+        ))])
 
         # create actual staging object
         st = self.env['runbot_merge.stagings'].create({
@@ -449,31 +466,44 @@ For-Commit-Id: %s
                 staging_head
             )
             refname = 'staging.{}'.format(self.name)
-            it['gh'].set_ref(refname, staging_head)
-            # asserts that the new head is visible through the api
-            head = it['gh'].head(refname)
-            assert head == staging_head,\
-                "[api] updated %s:%s to %s but found %s" % (
-                    r.name, refname,
-                    staging_head, head,
-                )
+            # register before updating the ref so the push hook can't
+            # arrive before we're listening for it
+            pushed = utils.staging_visibility.register(r.name, staging_head)
+            try:
+                it['gh'].set_ref(refname, staging_head)
+                # asserts that the new head is visible through the api
+                head = it['gh'].head(refname)
+                assert head == staging_head,\
+                    "[api] updated %s:%s to %s but found %s" % (
+                        r.name, refname,
+                        staging_head, head,
+                    )
 
-            i = itertools.count()
-            @utils.backoff(delays=WAIT_FOR_VISIBILITY, exc=TimeoutError)
-            def wait_for_visibility():
-                if self._check_visibility(r, refname, staging_head, token):
-                    _logger.info(
-                        "[repo] updated %s:%s to %s: ok (at %d/%d)",
+                i = itertools.count()
+                # the push hook only cuts the wait between two checks short,
+                # it doesn't say the ref is visible through git-upload-pack
+                # so the check must still run. Clear the latch once consumed
+                # so following waits are not skipped entirely.
+                def sleep(delay):
+                    if pushed.wait(delay):
+                        pushed.clear()
+                @utils.backoff(delays=WAIT_FOR_VISIBILITY, exc=TimeoutError, sleep=sleep)
+                def wait_for_visibility():
+                    if self._check_visibility(r, refname, staging_head, token):
+                        _logger.info(
+                            "[repo] updated %s:%s to %s: ok (at %d/%d)",
+                            r.name, refname, staging_head,
+                            next(i), len(WAIT_FOR_VISIBILITY)
+                        )
+                        return
+                    _logger.warning(
+                        "[repo] updated %s:%s to %s: failed (at %d/%d)",
                         r.name, refname, staging_head,
                         next(i), len(WAIT_FOR_VISIBILITY)
                     )
-                    return
-                _logger.warning(
-                    "[repo] updated %s:%s to %s: failed (at %d/%d)",
-                    r.name, refname, staging_head,
-                    next(i), len(WAIT_FOR_VISIBILITY)
-                )
-                raise TimeoutError("Staged head not updated after %d seconds" % sum(WAIT_FOR_VISIBILITY))
+                    raise TimeoutError("Staged head not updated after %d seconds" % sum(WAIT_FOR_VISIBILITY))
+            finally:
+                utils.staging_visibility.unregister(r.name, staging_head)
 
         logger.info("Created staging %s (%s) to %s", st, ', '.join(
             '%s[%s]' % (batch, batch.prs)
@@ -485,18 +515,33 @@ For-Commit-Id: %s
         """ Checks the repository actual to see if the new / expected head is
         now visible
         """
-        # v1 protocol provides URL for ref discovery: https://github.com/git/git/blob/6e0cc6776106079ed4efa0cc9abace4107657abf/Documentation/technical/http-protocol.txt#L187
-        # for more complete client this is also the capabilities discovery and
-        # the "entry point" for the service
-        url = 'https://github.com/{}.git/info/refs?service=git-upload-pack'.format(repo.name)
-        with requests.get(url, stream=True, auth=(token, '')) as resp:
-            if not resp.ok:
-                return False
-            for head, ref in parse_refs_smart(resp.raw.read):
-                if ref != ('refs/heads/' + branch_name):
-                    continue
-                return head == expected_head
+        ref = 'refs/heads/' + branch_name
+        try:
+            r = subprocess.run(
+                ['git', 'ls-remote', f'https://{token}@github.com/{repo.name}.git', ref],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'},
+                encoding='utf-8', timeout=5,
+            )
+        except subprocess.TimeoutExpired:
             return False
+        if r.returncode:
+            return False
+        for line in r.stdout.splitlines():
+            head, name = line.split('\t', 1)
+            if name == ref:
+                return head == expected_head
+        return False
+
+@functools.lru_cache(maxsize=256)
+def _mention_pattern(reference, number):
+    """ Compiles the pattern matching a mention of a PR, either through its
+    full ``reference`` (``number`` is then ``None``), or through its number
+    optionally prefixed by the repository (``reference``).
+    """
+    if number is None:
+        return re.compile(fr'\b{re.escape(reference)}\b')
+    return re.compile(fr'( |\b{reference})#{number}\b')
 
 ACL = collections.namedtuple('ACL', 'is_admin is_reviewer is_author')
 class PullRequests(models.Model):
@@ -653,6 +698,7 @@ class PullRequests(models.Model):
         ]) - self
 
     # missing link to other PRs
+    # NOTE: replicated in SQL by Branch._stageable, keep them in sync
     @api.depends('priority', 'state', 'squash', 'merge_method', 'batch_id.active', 'label')
     def _compute_is_blocked(self):
         self.blocked = False
@@ -1246,6 +1292,16 @@ class PullRequests(models.Model):
         """
         return Message.from_message(message)
 
+    def _mention_pattern(self, *, full_reference=False):
+        """Returns the (compiled) pattern matching mentions of ``self``
+
+        :param bool full_reference: whether the repository name must be present
+        :rtype: re.Pattern
+        """
+        if full_reference:
+            return _mention_pattern(self.display_name, None)
+        return _mention_pattern(self.repository.name, self.number)
+
     def _is_mentioned(self, message, *, full_reference=False):
         """Returns whether ``self`` is mentioned in ``message```
 
@@ -1253,12 +1309,8 @@ class PullRequests(models.Model):
         :param bool full_reference: whether the repository name must be present
         :rtype: bool
         """
-        if full_reference:
-            pattern = fr'\b{re.escape(self.display_name)}\b'
-        else:
-            repository = self.repository.name # .replace('/', '\\/')
-            pattern = fr'( |\b{repository})#{self.number}\b'
-        return bool(re.search(pattern, message if isinstance(message, str) else message.message))
+        pattern = self._mention_pattern(full_reference=full_reference)
+        return bool(pattern.search(message if isinstance(message, str) else message.message))
 
     def _build_merge_message(self, message, related_prs=()):
         # handle co-authored commits (https://help.github.com/articles/creating-a-commit-with-multiple-authors/)
@@ -1279,16 +1331,18 @@ class PullRequests(models.Model):
         """Adds a footer reference to ``self`` to all ``commits`` if they don't
         already refer to the PR.
         """
+        pattern = self._mention_pattern()
+        display_name = self.display_name
         for c in (c['commit'] for c in commits):
-            if not self._is_mentioned(c['message']):
+            if not pattern.search(c['message']):
                 m = self._parse_commit_message(c['message'])
                 m.headers.pop('Part-Of', None)
-                m.headers.add('Part-Of', self.display_name)
+                m.headers.add('Part-Of', display_name)
                 c['message'] = str(m)
 
     def _stage(self, gh, target, related_prs=()):
         # nb: pr_commits is oldest to newest so pr.head is pr_commits[-1]
-        _, prdict = gh.pr(self.number)
+        prdict, pr_commits = gh.pr_with_commits(self.number)
         commits = prdict['commits']
         method = self.merge_method or ('rebase-ff' if commits == 1 else None)
         if commits > 50 and method.startswith('rebase'):
@@ -1298,7 +1352,6 @@ class PullRequests(models.Model):
                 self, "Merging PRs of 250 or more commits is not supported "
                 "(https://developer.github.com/v3/pulls/#list-commits-on-a-pull-request)"
             )
-        pr_commits = gh.commits(self.number)
         for c in pr_commits:
             if not (c['commit']['author']['email'] and c['commit']['committer']['email']):
                 raise exceptions.Unmergeable(
@@ -2175,31 +2228,40 @@ class Batch(models.Model):
                     )
                 except Exception:
                     # reset the head which failed, as rebase() may have partially
-                    # updated it (despite later steps failing)
-                    gh.set_ref(target, original_head)
-                    # then reset every previous update
+                    # updated it (despite later steps failing), and every
+                    # previous update, all in different repositories so the
+                    # resets can be performed concurrently
+                    resets = [(gh, target, original_head)]
                     for to_revert in new_heads.keys():
                         it = meta[to_revert.repository]
-                        it['gh'].set_ref('tmp.{}'.format(to_revert.target.name), it['head'])
+                        resets.append((it['gh'], 'tmp.{}'.format(to_revert.target.name), it['head']))
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=len(resets)) as pool:
+                        # consume results so reset failures are surfaced
+                        list(pool.map(lambda r: r[0].set_ref(r[1], r[2]), resets))
                     raise
             except github.MergeError:
                 raise exceptions.MergeError(pr)
             except exceptions.Mismatch as e:
                 def format_items(items):
-                    """ Bit of a pain in the ass because difflib really wants
-                    all lines to be newline-terminated, but not all values are
-                    actual lines, and also needs to split multiline values.
+                    """ Single-line values are just shown as a before / after
+                    pair. Multiline values (e.g. the message) are diffed
+                    separately, using a unified diff as Differ is quadratic
+                    and messages can be quite large.
                     """
-                    for name, value in items:
-                        yield name + ':\n'
-                        if not value.endswith('\n'):
-                            value += '\n'
-                        yield from value.splitlines(keepends=True)
-                        yield '\n'
-
-                old = list(format_items((n, str(v)) for n, v, _ in e.args[1]))
-                new = list(format_items((n, str(v)) for n, _, v in e.args[1]))
-                diff = ''.join(Differ().compare(old, new))
+                    for name, old, new in items:
+                        if '\n' not in old and '\n' not in new:
+                            yield f'- {name}: {old}\n'
+                            yield f'+ {name}: {new}\n'
+                            continue
+
+                        yield f'  {name}:\n'
+                        # skip the (empty) file headers
+                        for line in itertools.islice(difflib.unified_diff(
+                            old.splitlines(), new.splitlines(), lineterm='',
+                        ), 2, None):
+                            yield line + '\n'
+
+                diff = ''.join(format_items((n, str(o), str(v)) for n, o, v in e.args[1]))
                 _logger.warning(
                     "data mismatch on %s:\n%s",
                     pr.display_name, diff
@@ -2295,26 +2357,6 @@ def to_status(v):
         return v
     return {'state': v, 'target_url': None, 'description': None}
 
-refline = re.compile(rb'([\da-f]{40}) ([^\0\n]+)(\0.*)?\n?$')
-ZERO_REF = b'0'*40
-def parse_refs_smart(read):
-    """ yields pkt-line data (bytes), or None for flush lines """
-    def read_line():
-        length = int(read(4), 16)
-        if length == 0:
-            return None
-        return read(length - 4)
-
-    header = read_line()
-    assert header.rstrip() == b'# service=git-upload-pack', header
-    assert read_line() is None, "failed to find first flush line"
-    # read lines until second delimiter
-    for line in iter(read_line, None):
-        if line.startswith(ZERO_REF):
-            break # empty list (no refs)
-        m = refline.match(line)
-        yield m[1].decode(), m[2].decode()
-
 BREAK = re.compile(r'''
     ^
     [ ]{0,3} # 0-3 spaces of indentation
@@ -2341,7 +2383,6 @@ HEADER = re.compile('^([A-Za-z-]+): (.*)$')
 class Message:
     @classmethod
     def from_message(cls, msg):
-        in_headers = True
         maybe_setex = None
         # creating from PR message -> remove content following break
         msg, handle_break = (msg, False) if isinstance(msg, str) else (msg.message, True)
@@ -2349,7 +2390,10 @@ class Message:
         body = []
         # don't process the title (first line) of the commit message
         msg = msg.splitlines()
-        for line in reversed(msg[1:]):
+        # walk the message backwards, first through the trailing headers
+        # block, then through the body proper, in a single pass
+        lines = reversed(msg[1:])
+        for line in lines:
             if maybe_setex:
                 # NOTE: actually slightly more complicated: it's a SETEX heading
                 #       only if preceding line(s) can be interpreted as a
@@ -2364,8 +2408,6 @@ class Message:
                 maybe_setex = None
 
             if not line:
-                if not in_headers and body and body[-1]:
-                    body.append(line)
                 continue
 
             if handle_break and BREAK.match(line):
@@ -2377,13 +2419,43 @@ class Message:
 
             h = HEADER.match(line)
             if h:
-                # c-a-b = special case from an existing test, not sure if actually useful?
-                if in_headers or h.group(1).lower() == 'co-authored-by':
+                headers.append(h.groups())
+                continue
+
+            # end of the headers block
+            body.append(line)
+            break
+
+        for line in lines:
+            if maybe_setex:
+                if line:
+                    body.append(maybe_setex)
+                else:
+                    body = []
+                maybe_setex = None
+
+            if not line:
+                if body and body[-1]:
+                    body.append(line)
+                continue
+
+            # cheap prefilter, a break must start with one of these (after
+            # up to 3 spaces)
+            if handle_break and line.lstrip(' ')[:1] in '*_-' and BREAK.match(line):
+                if SETEX_UNDERLINE.match(line):
+                    maybe_setex = line
+                else:
+                    body = []
+                continue
+
+            # c-a-b = special case from an existing test, not sure if actually useful?
+            if line[:16].lower() == 'co-authored-by: ':
+                h = HEADER.match(line)
+                if h:
                     headers.append(h.groups())
                     continue
 
             body.append(line)
-            in_headers = False
 
         # if there are non-title body lines, add a separation after the title
         if body and body[-1]:
@@ -2405,22 +2477,17 @@ class Message:
         if not self.headers:
             return self.body + '\n'
 
-        with io.StringIO(self.body) as msg:
-            msg.write(self.body)
-            msg.write('\n\n')
-            # https://git.wiki.kernel.org/index.php/CommitMessageConventions
-            # seems to mostly use capitalised names (rather than title-cased)
-            keys = list(OrderedSet(k.capitalize() for k in self.headers.keys()))
-            # c-a-b must be at the very end otherwise github doesn't see it
-            keys.sort(key=lambda k: k == 'Co-authored-by')
-            for k in keys:
-                for v in self.headers.getlist(k):
-                    msg.write(k)
-                    msg.write(': ')
-                    msg.write(v)
-                    msg.write('\n')
-
-            return msg.getvalue()
+        # https://git.wiki.kernel.org/index.php/CommitMessageConventions
+        # seems to mostly use capitalised names (rather than title-cased)
+        keys = list(dict.fromkeys(k.capitalize() for k in self.headers.keys()))
+        # c-a-b must be at the very end otherwise github doesn't see it
+        keys.sort(key=lambda k: k == 'Co-authored-by')
+        return '\n'.join([
+            self.body,
+            '',
+            *(f'{k}: {v}' for k in keys for v in self.headers.getlist(k)),
+            '',
+        ])
 
     def sub(self, pattern, repl, *, flags):
         """ Performs in-place replacements on the body
@@ -2461,20 +2461,16 @@ The properties Head, Target, Message were not correctly synchronized and have be
 <details><summary>differences</summary>
 
 ```diff
-  Head:
-- {}
-+ {}
-  
-  Target branch:
-- somethingelse
-+ master
-  
+- Head: {}
++ Head: {}
+- Target branch: somethingelse
++ Target branch: master
   Message:
-- Something else
-+ title
-  
-+ body
-+ 
+@@ -1 +1,3 @@
+-Something else
++title
++
++body
 ```
 </details>
 
@@ -2502,11 +2498,11 @@ The properties Message were not correctly synchronized and have been updated.
 
 ```diff
   Message:
-- wrong
-+ title
-  
-+ body
-+ 
+@@ -1 +1,3 @@
+-wrong
++title
++
++body
 ```
 </details>
 
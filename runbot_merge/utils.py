@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import itertools
+import random
+import threading
 import time
 
 
@@ -19,9 +21,9 @@ def shorten(text_ish, length):
     return text_ish[:length-3] + cont
 
 BACKOFF_DELAYS = (0.1, 0.2, 0.4, 0.8, 1.6)
-def backoff(func=None, *, delays=BACKOFF_DELAYS, exc=Exception):
+def backoff(func=None, *, delays=BACKOFF_DELAYS, exc=Exception, sleep=time.sleep):
     if func is None:
-        return lambda func: backoff(func, delays=delays, exc=exc)
+        return lambda func: backoff(func, delays=delays, exc=exc, sleep=sleep)
 
     for delay in itertools.chain(delays, [None]):
         try:
@@ -29,7 +31,45 @@ def backoff(func=None, *, delays=BACKOFF_DELAYS, exc=Exception):
         except exc:
             if delay is None:
                 raise
-            time.sleep(delay)
+            # jitter the delay so concurrent retries don't all hit at once
+            sleep(random.uniform(delay * 0.5, delay * 1.5))
+
+class StagingVisibilityRegistry:
+    """ Latches signalled by the ``push`` webhook when a staging ref is
+    updated, so staging creation can wake up as soon as github notifies us
+    rather than wait out the entire polling delay.
+
+    Only works if the webhook is handled by the same process as the staging
+    cron (e.g. threaded mode), otherwise the latch never fires and callers
+    are left with the polling fallback.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+
+    def register(self, repo, sha):
+        """ Registers interest in ``sha`` becoming visible on ``repo``,
+        should be called *before* updating the ref so the hook can't race
+        the registration.
+        """
+        with self._lock:
+            return self._events.setdefault((repo, sha), threading.Event())
+
+    def unregister(self, repo, sha):
+        with self._lock:
+            self._events.pop((repo, sha), None)
+
+    def signal(self, repo, sha):
+        """ Returns whether anything was waiting on ``(repo, sha)``
+        """
+        with self._lock:
+            event = self._events.get((repo, sha))
+        if event is None:
+            return False
+        event.set()
+        return True
+
+staging_visibility = StagingVisibilityRegistry()
 
 def make_message(pr_dict):
     title = pr_dict['title'].strip()